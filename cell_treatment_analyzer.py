@@ -9,14 +9,23 @@ Author: Toby Reid
 """
 
 import argparse
+from array import array
+from collections.abc import Callable, Iterable
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
 import os
 import sys
+import tempfile
+from typing import TextIO
 
 from matplotlib import pyplot
 from matplotlib.figure import Figure as PyplotFigure
+import numpy as np
+from scipy.stats import mannwhitneyu
 
-from common import CELL_TYPES, DEFAULT_DELIMITER, SAMPLE_HEADER, Csv, CsvHeaders, \
-    ExpandPathAction, ValidatePathAction, get_csv_headers, read_csv, write_csv
+from common import CELL_INDEX, CELL_TYPE_ORDER, CELL_TYPES, DEFAULT_DELIMITER, ENCODING, \
+    SAMPLE_HEADER, Csv, CsvHeaders, ExpandPathAction, ValidatePathAction, file_sha256, \
+    get_csv_headers, read_csv, write_csv_rows
 from relative_cell_counter import convert_cell_count
 from relative_cell_counter import OUTPUT_HEADERS as RELATIVE_HEADERS
 
@@ -31,84 +40,216 @@ RESPONSE_HEADER = "response"
 RESPONDING = "y"
 NONRESPONDING = "n"
 
+# The p-value below which a difference between responders and nonresponders is significant
+SIGNIFICANCE_LEVEL = 0.05
 
-def get_sample_relative(relative_headers: CsvHeaders, relative_csv: Csv, sample_id: str) \
-        -> dict[CELL_TYPES, float]:
+# Appended to a generated relative CSV's path to store the hash of the treatment CSV it came from
+SOURCE_HASH_SUFFIX = ".sha256"
+# Plain encoding (no BOM), so other tools can compare the digest directly
+SOURCE_HASH_ENCODING = "ascii"
+
+
+def needs_source_hash(relative_csv_path: str) -> bool:
+    """
+    Checks whether the treatment CSV's hash will be needed for the given relative CSV, either to
+    check a recorded source hash or to record one for a newly generated relative CSV.
+
+    Args:
+        relative_csv_path (str): The path to the relative CSV
+
+    Returns:
+        bool: True if the treatment CSV should be hashed
+    """
+    return not os.path.exists(relative_csv_path) \
+        or os.path.isfile(relative_csv_path + SOURCE_HASH_SUFFIX)
+
+
+def is_relative_csv_current(relative_csv_path: str, treatment_hash: str | None) -> bool:
+    """
+    Checks whether a relative CSV can be reused instead of regenerating it from the treatment data.
+
+    A relative CSV generated by this tool is stale if the treatment CSV has since changed. One
+    without a recorded source hash (e.g., made by relative_cell_counter) is trusted as given.
+
+    Args:
+        relative_csv_path (str):     The path to the relative CSV
+        treatment_hash (str | None): The SHA-256 digest of the treatment CSV, if it was needed
+
+    Returns:
+        bool: True if the relative CSV exists and is not stale
+    """
+    if not os.path.isfile(relative_csv_path):
+        return False
+    hash_path = relative_csv_path + SOURCE_HASH_SUFFIX
+    if not os.path.isfile(hash_path):
+        return True
+    with open(hash_path, 'r', encoding=SOURCE_HASH_ENCODING) as file:
+        return file.read().strip() == treatment_hash
+
+
+def replace_file(file_path: str, write: Callable[[TextIO], None], encoding: str,
+                 newline: str | None=None) -> None:
+    """
+    Writes a file to a uniquely named temporary file beside it, then moves that into place, so the
+    file is never left partially written.
+
+    The temporary file is removed if writing fails, and is given the permissions a newly created
+    file would normally have.
+
+    Args:
+        file_path (str):                  The path of the file to write
+        write (Callable[[TextIO], None]): Writes the contents to the given open file
+        encoding (str):                   The encoding of the file
+        newline (str | None):             How newlines are translated, as for `open`
+    """
+    directory, file_name = os.path.split(os.path.abspath(file_path))
+    temp_file = tempfile.NamedTemporaryFile('w', encoding=encoding, newline=newline, dir=directory,
+                                            prefix=f"{file_name}.", suffix=".tmp", delete=False)
+    try:
+        with temp_file:
+            write(temp_file)
+        # Temporary files are private to the owner; match what `open` would have created instead
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp_file.name, 0o666 & ~umask)
+        os.replace(temp_file.name, file_path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(temp_file.name)
+        raise
+
+
+def write_source_hash(relative_csv_path: str, treatment_hash: str) -> None:
+    """
+    Records the hash of the treatment CSV that a relative CSV was generated from.
+
+    Args:
+        relative_csv_path (str): The path to the generated relative CSV
+        treatment_hash (str):    The SHA-256 digest of the treatment CSV
+    """
+    replace_file(relative_csv_path + SOURCE_HASH_SUFFIX, lambda file: file.write(treatment_hash),
+                 SOURCE_HASH_ENCODING)
+
+
+def write_relative_csv(relative_csv_path: str, header_row: list[str], relative_csv: Csv,
+                       delimiter: str=DEFAULT_DELIMITER) -> None:
+    """
+    Saves a generated relative CSV, so that later runs can reuse it.
+
+    Args:
+        relative_csv_path (str): The path to which to save the relative CSV
+        header_row (list[str]):  The header row of the relative CSV
+        relative_csv (Csv):      The remaining rows of the relative CSV
+        delimiter (str):         The delimiter to use in the relative CSV
     """
-    Retrieves all relative percentages of a given sample for each of the cell type populations.
+    replace_file(relative_csv_path,
+                 lambda file: write_csv_rows(file, relative_csv, delimiter, header_row),
+                 ENCODING, newline='')
+    print(f"Wrote output CSV to {relative_csv_path}")
+
+
+def index_sample_relative(relative_headers: CsvHeaders, relative_csv: Iterable[list[str]]) \
+        -> dict[str, list[float | None]]:
+    """
+    Indexes all relative percentages by sample, for each of the cell type populations, in a single
+    pass over the relative CSV.
 
     Args:
-        relative_headers (CsvHeaders): A mapping of header names to their respective indices
-        relative_csv (Csv):            The CSV containing the relative cell counts
-        sample_id (str):               The sample name for which to retrieve the relative counts
+        relative_headers (CsvHeaders):      A mapping of header names to their respective indices
+        relative_csv (Iterable[list[str]]): The rows of the CSV containing the relative cell counts
 
     Returns:
-        dict[CELL_TYPES, float]: A mapping of cell types to their respective relative percentages
+        dict[str, list[float | None]]: A mapping of sample names to their relative percentages, \
+                                       positioned by `CELL_INDEX` (None if the sample has no \
+                                       entry for that population)
+
+    Raises:
+        ValueError: if any sample has multiple entries for the same population, or has an entry for
+                    an unknown population
     """
-    sample_responders: dict[CELL_TYPES, float] = {}
+    sample_col = relative_headers[SAMPLE_HEADER]
+    population_col = relative_headers[RELATIVE_HEADERS.POPULATION]
+    percentage_col = relative_headers[RELATIVE_HEADERS.PERCENTAGE]
+    population_count = len(CELL_TYPE_ORDER)
+
+    sample_index: dict[str, list[float | None]] = {}
     for csv_row in relative_csv:
-        if csv_row[relative_headers[SAMPLE_HEADER]] == sample_id:
-            cell_type = csv_row[relative_headers[RELATIVE_HEADERS.POPULATION]]
-            if sample_responders.get(cell_type):
-                raise ValueError("Given CSV is invalid; expected 1 entry per population, per "
-                                 f"sample, but got multiple entries for sample {sample_id} with "
-                                 f"population {cell_type}")
-            population_percentage = float(csv_row[relative_headers[RELATIVE_HEADERS.PERCENTAGE]])
-            sample_responders[cell_type] = population_percentage
-    return sample_responders
+        sample_id = csv_row[sample_col]
+        cell_type = csv_row[population_col]
+        population_ix = CELL_INDEX.get(cell_type)
+        if population_ix is None:
+            raise ValueError(f"Given CSV is invalid; sample {sample_id} has unknown population "
+                             f"{cell_type}")
+        sample_relative = sample_index.get(sample_id)
+        if sample_relative is None:
+            sample_relative = sample_index[sample_id] = [None] * population_count
+        elif sample_relative[population_ix] is not None:
+            raise ValueError("Given CSV is invalid; expected 1 entry per population, per "
+                             f"sample, but got multiple entries for sample {sample_id} with "
+                             f"population {cell_type}")
+        sample_relative[population_ix] = float(csv_row[percentage_col])
+    return sample_index
 
 
 def calculate_responders(treatment_headers: CsvHeaders, treatment_csv: Csv,
-                         relative_headers: CsvHeaders, relative_csv: Csv) \
-        -> tuple[dict[CELL_TYPES, list[float]], dict[CELL_TYPES, list[float]]]:
+                         relative_headers: CsvHeaders, relative_csv: Iterable[list[str]]) \
+        -> tuple[list[np.ndarray], list[np.ndarray]]:
     """
     Locates all data points for responders and non-responders for each data type within the given
     treatment data.
 
     Args:
-        treatment_headers (CsvHeaders): A mapping of header names to their respective indices
-        treatment_csv (Csv):            The CSV containing the treatment data
-        relative_headers (CsvHeaders):  A mapping of header names to their respective indices
-        relative_csv (Csv):             The CSV containing the relative cell counts
+        treatment_headers (CsvHeaders):     A mapping of header names to their respective indices
+        treatment_csv (Csv):                The CSV containing the treatment data
+        relative_headers (CsvHeaders):      A mapping of header names to their respective indices
+        relative_csv (Iterable[list[str]]): The rows of the CSV containing the relative cell counts
 
     Returns:
-        tuple[dict[CELL_TYPES, list[float]], dict[CELL_TYPES, list[float]]]:
-            responders:    A mapping of cell types to lists of relative counts samples where the \
-                           data indicate a response
-            nonresponders: A mapping of cell types to lists of relative counts samples where the \
-                           data indicate no response
-    """
-    population_responders: dict[CELL_TYPES, list[float]] = {}
-    population_nonresponders: dict[CELL_TYPES, list[float]] = {}
-    for cell_type in CELL_TYPES:
-        population_responders[cell_type] = []
-        population_nonresponders[cell_type] = []
-
+        tuple[list[np.ndarray], list[np.ndarray]]:
+            responders:    Arrays of relative counts of samples where the data indicate a \
+                           response, positioned by `CELL_INDEX`
+            nonresponders: Arrays of relative counts of samples where the data indicate no \
+                           response, positioned by `CELL_INDEX`
+    """
+    population_responders: list[array] = [array('d') for _ in CELL_TYPE_ORDER]
+    population_nonresponders: list[array] = [array('d') for _ in CELL_TYPE_ORDER]
+
+    sample_index = index_sample_relative(relative_headers, relative_csv)
+    treatment_col = treatment_headers[TREATMENT_HEADER]
+    sample_type_col = treatment_headers[SAMPLE_TYPE_HEADER]
+    sample_col = treatment_headers[SAMPLE_HEADER]
+    response_col = treatment_headers[RESPONSE_HEADER]
     for sample in treatment_csv:
-        if sample[treatment_headers[TREATMENT_HEADER]] == TREATMENT \
-                and sample[treatment_headers[SAMPLE_TYPE_HEADER]] in INCLUDE_SAMPLE_TYPES:
-            sample_id = sample[treatment_headers[SAMPLE_HEADER]]
-            sample_relative_count = get_sample_relative(relative_headers, relative_csv, sample_id)
+        # Each cell is only compared once, so interning it first (to compare by identity) would
+        # cost more than the plain string comparisons it replaces
+        if sample[treatment_col] == TREATMENT and sample[sample_type_col] in INCLUDE_SAMPLE_TYPES:
+            sample_relative_count = sample_index.get(sample[sample_col])
+            if sample_relative_count is None:
+                continue
             # Select which counter to use, based on whether the sample is a responder
             population_counter = \
-                population_responders if sample[treatment_headers[RESPONSE_HEADER]] == RESPONDING \
+                population_responders if sample[response_col] == RESPONDING \
                 else population_nonresponders
-            for cell_type, relative_count in sample_relative_count.items():
-                population_counter[cell_type].append(relative_count)
+            for population_values, relative_count in zip(population_counter,
+                                                         sample_relative_count):
+                if relative_count is not None:
+                    population_values.append(relative_count)
 
-    return population_responders, population_nonresponders
+    # Wrap the collected doubles in place, rather than having them copied later on
+    return [np.frombuffer(values, dtype=np.float64) for values in population_responders], \
+        [np.frombuffer(values, dtype=np.float64) for values in population_nonresponders]
 
 
-def generate_boxplot(label: str, responders: list[float], nonresponders: list[float]) \
+def generate_boxplot(label: str, responders: np.ndarray, nonresponders: np.ndarray) \
         -> PyplotFigure:
     """
     Generates a singular boxplot comparing the relative cell counts of a cell type, showing both
     responders and nonresponders.
 
     Args:
-        label (str):                 The label to use for the plot (the cell type)
-        responders (list[float]):    The relative cell counts for responders
-        nonresponders (list[float]): The relative cell counts for nonresponders
+        label (str):                The label to use for the plot (the cell type)
+        responders (np.ndarray):    The relative cell counts for responders
+        nonresponders (np.ndarray): The relative cell counts for nonresponders
 
     Returns:
         PyplotFigure: The generated boxplot
@@ -123,30 +264,67 @@ def generate_boxplot(label: str, responders: list[float], nonresponders: list[fl
     return figure
 
 
-def generate_boxplots(treatment_headers: CsvHeaders, treatment_csv: Csv,
-                      relative_headers: CsvHeaders, relative_csv: Csv) \
+def generate_boxplots(responders: list[np.ndarray], nonresponders: list[np.ndarray]) \
         -> dict[CELL_TYPES, PyplotFigure]:
     """
-    Calculates and generates boxplots for each cell type, comparing responders and nonresponders.
+    Generates boxplots for each cell type, comparing responders and nonresponders.
 
     Args:
-        treatment_headers (CsvHeaders): A mapping of header names to their respective indices
-        treatment_csv (Csv):            The CSV containing the treatment data
-        relative_headers (CsvHeaders):  A mapping of header names to their respective indices
-        relative_csv (Csv):             The CSV containing the relative cell counts
+        responders (list[np.ndarray]):    The relative cell counts for responders, positioned by \
+                                          `CELL_INDEX`
+        nonresponders (list[np.ndarray]): The relative cell counts for nonresponders, positioned \
+                                          by `CELL_INDEX`
 
     Returns:
         dict[CELL_TYPES, PyplotFigure]: A mapping of cell types to their respective boxplots
     """
-    responders, nonresponders = calculate_responders(treatment_headers, treatment_csv,
-                                                     relative_headers, relative_csv)
     boxplots: dict[CELL_TYPES, PyplotFigure] = {}
-    for cell_type in CELL_TYPES:
-        boxplots[cell_type] = generate_boxplot(cell_type, responders[cell_type],
-                                               nonresponders[cell_type])
+    for population_ix, cell_type in enumerate(CELL_TYPE_ORDER):
+        boxplots[cell_type] = generate_boxplot(cell_type, responders[population_ix],
+                                               nonresponders[population_ix])
     return boxplots
 
 
+def calculate_significance(responders: list[np.ndarray], nonresponders: list[np.ndarray]) \
+        -> np.ndarray:
+    """
+    Tests whether the relative cell counts of responders and nonresponders differ for each cell
+    type, using a two-sided Mann-Whitney U test.
+
+    When every tested cell type has the same number of responder and nonresponder samples (the
+    usual case, as each sample covers every population), all are tested in a single vectorized
+    call; otherwise, each cell type is tested separately.
+
+    Args:
+        responders (list[np.ndarray]):    The relative cell counts for responders, positioned by \
+                                          `CELL_INDEX`
+        nonresponders (list[np.ndarray]): The relative cell counts for nonresponders, positioned \
+                                          by `CELL_INDEX`
+
+    Returns:
+        np.ndarray: The p-value of each cell type, positioned by `CELL_INDEX` (NaN if the cell type
+                    has no responder or no nonresponder samples, so can't be tested)
+    """
+    p_values = np.full(len(responders), np.nan)
+    # Empty groups can't be tested, and would only make SciPy warn and return NaN
+    tested = [population_ix for population_ix in range(len(responders))
+              if len(responders[population_ix]) and len(nonresponders[population_ix])]
+    if not tested:
+        return p_values
+
+    tested_responders = [responders[population_ix] for population_ix in tested]
+    tested_nonresponders = [nonresponders[population_ix] for population_ix in tested]
+    if len(set(map(len, tested_responders))) == 1 and len(set(map(len, tested_nonresponders))) == 1:
+        p_values[tested] = mannwhitneyu(np.vstack(tested_responders),
+                                        np.vstack(tested_nonresponders), axis=1).pvalue
+    else:
+        for population_ix, population_responders, population_nonresponders \
+                in zip(tested, tested_responders, tested_nonresponders):
+            p_values[population_ix] = mannwhitneyu(population_responders,
+                                                   population_nonresponders).pvalue
+    return p_values
+
+
 def parse_args(args: list[str]) -> argparse.Namespace:
     """
     Parses command-line arguments for this tool.
@@ -173,7 +351,8 @@ def parse_args(args: list[str]) -> argparse.Namespace:
         action=ExpandPathAction,
         nargs='?',  # the argument is optional
         help=("A CSV file containing relative cell counts, as generated by relative_cell_counter. "
-              "If the file does not exist, it will be created"),
+              "If the file does not exist, or was created by this tool from a different treatment "
+              "CSV, it will be (re)created"),
     )
     parser.add_argument(
         "-b", "--boxplot-dir",
@@ -210,35 +389,66 @@ def main(args: list[str]) -> int:
         int: Exit code of the script (0 on success)
     """
     arg_values = parse_args(args)
+    if arg_values.boxplot_dir:
+        # Plots are only being saved, so skip the cost of setting up an interactive backend
+        pyplot.switch_backend("agg")
+    # Hash the treatment CSV before reading it; if it changes in between, the recorded hash is then
+    # the older one, so the cache gets regenerated next time rather than trusted
+    treatment_hash = None
+    if arg_values.relative_csv and needs_source_hash(arg_values.relative_csv):
+        treatment_hash = file_sha256(arg_values.treatment_csv)
+
     required_headers = [SAMPLE_HEADER, TREATMENT_HEADER, SAMPLE_TYPE_HEADER, RESPONSE_HEADER] \
                        + list(CELL_TYPES)
-    treatment_headers, treatment_csv = read_csv(arg_values.treatment_csv, required_headers,
-                                                delimiter=arg_values.delimiter)
+    treatment_headers, treatment_rows = read_csv(arg_values.treatment_csv, required_headers,
+                                                 delimiter=arg_values.delimiter)
+    # The treatment data may be traversed more than once, so it can't be left as a stream
+    treatment_csv = list(treatment_rows)
 
-    if not arg_values.relative_csv or not os.path.isfile(arg_values.relative_csv):
+    if arg_values.relative_csv and is_relative_csv_current(arg_values.relative_csv,
+                                                           treatment_hash):
+        # We were provided with a CSV
+        relative_headers, relative_csv = read_csv(arg_values.relative_csv,
+                                                  RELATIVE_HEADERS,
+                                                  delimiter=arg_values.delimiter)
+    else:
         # Make our own CSV
-        relative_csv = convert_cell_count(treatment_headers, treatment_csv)
-        relative_headers = get_csv_headers(relative_csv.pop(0), RELATIVE_HEADERS)
+        relative_header_row, relative_rows = convert_cell_count(treatment_headers, treatment_csv)
+        relative_headers = get_csv_headers(relative_header_row, RELATIVE_HEADERS)
+        relative_csv = list(relative_rows)
         if arg_values.relative_csv:
-            if not os.path.exists(arg_values.relative_csv):
-                file_csv = [RELATIVE_HEADERS] + relative_csv
-                write_csv(arg_values.relative_csv, file_csv, delimiter=arg_values.delimiter)
+            # Save it straight away, so later runs can skip the conversion
+            # A missing or stale relative CSV always has the treatment hash computed for it
+            if treatment_hash is not None and (not os.path.exists(arg_values.relative_csv)
+                                               or os.path.isfile(arg_values.relative_csv)):
+                write_relative_csv(arg_values.relative_csv, relative_header_row, relative_csv,
+                                   delimiter=arg_values.delimiter)
+                write_source_hash(arg_values.relative_csv, treatment_hash)
             else:
                 print(f"Couldn't write CSV file {arg_values.relative_csv} as the path already "
                       "exists, yet is not a file", file=sys.stderr)
-    else:
-        # We were provided with a CSV
-        relative_headers, relative_csv = read_csv(arg_values.relative_csv,
-                                                  RELATIVE_HEADERS,
-                                                  delimiter=arg_values.delimiter)
 
-    boxplots = generate_boxplots(treatment_headers, treatment_csv, relative_headers, relative_csv)
+    responders, nonresponders = calculate_responders(treatment_headers, treatment_csv,
+                                                     relative_headers, relative_csv)
+    p_values = calculate_significance(responders, nonresponders)
+    print(f"Mann-Whitney U test p-values, {TREATMENT} responders vs. nonresponders:")
+    for cell_type, p_value in zip(CELL_TYPE_ORDER, p_values):
+        if np.isnan(p_value):
+            print(f"    {cell_type}: could not be tested (no responder or no nonresponder samples)")
+            continue
+        significance = " (significant)" if p_value < SIGNIFICANCE_LEVEL else ""
+        print(f"    {cell_type}: {p_value:.4g}{significance}")
+
+    boxplots = generate_boxplots(responders, nonresponders)
     if arg_values.boxplot_dir:
         os.makedirs(arg_values.boxplot_dir, exist_ok=True)
-        for cell_type, boxplot in boxplots.items():
-            file_path = os.path.join(arg_values.boxplot_dir, f"{cell_type}.png")
-            boxplot.savefig(file_path)
-            print(f"Saved {cell_type} plot as {file_path}")
+        file_paths = [os.path.join(arg_values.boxplot_dir, f"{cell_type}.png")
+                      for cell_type in boxplots]
+        # Each plot is a separate figure, and PNG encoding releases the GIL, so save them together
+        with ThreadPoolExecutor() as executor:
+            saves = executor.map(PyplotFigure.savefig, boxplots.values(), file_paths)
+            for cell_type, file_path, _ in zip(boxplots, file_paths, saves):
+                print(f"Saved {cell_type} plot as {file_path}")
     else:
         print("Displaying all charts in separate windows")
         pyplot.show()
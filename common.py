@@ -6,10 +6,13 @@ Author: Toby Reid
 """
 
 import argparse
+from collections.abc import Iterable, Iterator
 import csv
 from enum import StrEnum
+import hashlib
 import os
 import sys
+from typing import TextIO
 
 
 ENCODING = "utf-8-sig"
@@ -23,11 +26,16 @@ CELL_TYPES = StrEnum("Immune Cell Types", [
     "MONOCYTE",
 ])
 
+# Fixed positions of each cell type, for storing per-population values in plain lists
+CELL_TYPE_ORDER = list(CELL_TYPES)
+CELL_INDEX = {cell_type: index for index, cell_type in enumerate(CELL_TYPE_ORDER)}
+
 SAMPLE_HEADER = "sample"
 
 # type definitions
 CsvHeaders = dict[str, int]
 Csv = list[list[str]]
+CsvRows = Iterator[list[str]]
 
 
 class ExpandPathAction(argparse.Action):
@@ -57,8 +65,9 @@ def get_csv_headers(header_row: list[str], required_headers: list[str]) -> CsvHe
     Extracts the indices of the headers required for this module from the given Header row.
 
     Parameters:
-        header_row (list[str]): The original CSV's header row, which should contain all required \
-                                headers
+        header_row (list[str]):       The original CSV's header row, which should contain all \
+                                      required headers
+        required_headers (list[str]): The headers whose indices are needed
 
     Returns:
         CsvHeaders: A mapping of header names to their respective indices
@@ -66,41 +75,91 @@ def get_csv_headers(header_row: list[str], required_headers: list[str]) -> CsvHe
     Raises:
         ValueError: if the provided header row is missing any required headers
     """
-    if not all((header in header_row) for header in required_headers):
+    # Index the header row once, keeping the first occurrence of any duplicated header
+    header_indices: CsvHeaders = {}
+    for index, header in enumerate(header_row):
+        header_indices.setdefault(header, index)
+    if any((header not in header_indices) for header in required_headers):
         raise ValueError("CSV is missing one or more required headers; expected all of '"
                          + "', '".join(str(header) for header in required_headers) + "'")
-    csv_headers: CsvHeaders = {}
-    for header in required_headers:
-        csv_headers[header] = header_row.index(header)
-    return csv_headers
+    return {header: header_indices[header] for header in required_headers}
+
+
+def file_sha256(file_path: str) -> str:
+    """
+    Computes the SHA-256 digest of a file's contents.
+
+    Args:
+        file_path (str): The path to the file to hash
+
+    Returns:
+        str: The hexadecimal digest of the file
+    """
+    with open(file_path, 'rb') as file:
+        return hashlib.file_digest(file, "sha256").hexdigest()
+
+
+def iter_csv_rows(csv_path: str, delimiter: str=DEFAULT_DELIMITER) -> CsvRows:
+    """
+    Lazily yields each row of a CSV file, keeping the file open only while rows are being consumed.
+
+    Args:
+        csv_path (str):  The file path to the CSV file to be read
+        delimiter (str): The delimiter used in the CSV file
+
+    Yields:
+        list[str]: Each row of the CSV file, in order
+    """
+    with open(csv_path, 'r', encoding=ENCODING, newline='') as file:
+        yield from csv.reader(file, delimiter=delimiter)
 
 
 def read_csv(csv_path: str, required_headers: list[str], delimiter: str=DEFAULT_DELIMITER) \
-        -> tuple[CsvHeaders, Csv]:
+        -> tuple[CsvHeaders, CsvRows]:
     """
     Reads a CSV file and validates its header row.
 
+    The remaining rows are streamed rather than loaded into memory, so they may only be iterated
+    once; callers needing multiple passes should collect them with `list`.
+
     Args:
         csv_path (str):  The file path to the CSV file to be read
         delimiter (str): The delimiter used in the CSV file
 
     Returns:
-        tuple[CsvHeaders, Csv]: A tuple containing the headers and the rows of the CSV file
+        tuple[CsvHeaders, CsvRows]: A tuple containing the headers and an iterator over the \
+                                    remaining rows of the CSV file
 
     Raises:
         ValueError: If the CSV file is empty or is missing required headers
     """
-    with open(csv_path, 'r', encoding=ENCODING, newline='') as file:
-        reader = csv.reader(file, delimiter=delimiter)
-        csv_rows = list(reader)
-    if not csv_rows:
+    csv_rows = iter_csv_rows(csv_path, delimiter=delimiter)
+    header_row = next(csv_rows, None)
+    if header_row is None:
         raise ValueError(f"Failed to parse empty CSV: {csv_path}")
 
-    header_row = csv_rows.pop(0)
     return get_csv_headers(header_row, required_headers), csv_rows
 
 
-def write_csv(output_file: str | None, output_csv: Csv, delimiter: str=DEFAULT_DELIMITER) -> None:
+def write_csv_rows(file: TextIO, output_csv: Iterable[list[str]], delimiter: str,
+                   header: list[str] | None) -> None:
+    """
+    Writes an optional header row followed by the given CSV rows to an open file.
+
+    Args:
+        file (TextIO):                    The file to write to
+        output_csv (Iterable[list[str]]): The CSV rows to write
+        delimiter (str):                  The delimiter to use in the output CSV
+        header (list[str] | None):        A header row to write before the other rows, if any
+    """
+    writer = csv.writer(file, delimiter=delimiter)
+    if header is not None:
+        writer.writerow(header)
+    writer.writerows(output_csv)
+
+
+def write_csv(output_file: str | None, output_csv: Iterable[list[str]],
+              delimiter: str=DEFAULT_DELIMITER, header: list[str] | None=None) -> None:
     """
     Writes the given CSV to the specified file, or to stdout if no file is specified.
 
@@ -108,16 +167,15 @@ def write_csv(output_file: str | None, output_csv: Csv, delimiter: str=DEFAULT_D
         output_file (str | None):
             str:  The file path to write the output CSV <br/>
             None: to write to stdout
-        output_csv (Csv):         The CSV data to write
-        delimiter (str):          The delimiter to use in the output CSV
+        output_csv (Iterable[list[str]]): The CSV rows to write
+        delimiter (str):                  The delimiter to use in the output CSV
+        header (list[str] | None):        A header row to write before the other rows, if any
     """
     if output_file is None:
-        writer = csv.writer(sys.stdout, delimiter=delimiter)
-        writer.writerows(output_csv)
+        write_csv_rows(sys.stdout, output_csv, delimiter, header)
     else:
         with open(output_file, 'w', encoding=ENCODING, newline='') as file:
-            writer = csv.writer(file, delimiter=delimiter)
-            writer.writerows(output_csv)
+            write_csv_rows(file, output_csv, delimiter, header)
         print(f"Wrote output CSV to {output_file}")
 
 
@@ -9,14 +9,27 @@ Author: Toby Reid
 """
 
 import argparse
+from collections import deque
+from collections.abc import Callable, Iterable
 from enum import StrEnum
+from itertools import chain, islice
+from multiprocessing import Pool
+from multiprocessing.pool import AsyncResult
+from operator import itemgetter
+import os
 import sys
 
-from common import CELL_TYPES, DEFAULT_DELIMITER, SAMPLE_HEADER, Csv, CsvHeaders, \
-    ExpandPathAction, ValidatePathAction, read_csv, write_csv
+import numpy as np
 
+from common import CELL_TYPE_ORDER, CELL_TYPES, DEFAULT_DELIMITER, SAMPLE_HEADER, Csv, \
+    CsvHeaders, CsvRows, ExpandPathAction, ValidatePathAction, read_csv, write_csv
+
+
+# The number of input rows converted together as one array
+BATCH_SIZE = 10_000
+# The number of batches each worker process may have queued or in progress at once
+BATCHES_PER_PROCESS = 2
 
-# If this order is updated, the order in `get_output_csv_row` will also need to be updated.
 OUTPUT_HEADERS = StrEnum("Output CSV Headers", [
     SAMPLE_HEADER.upper(),
     "TOTAL_COUNT",
@@ -25,66 +38,202 @@ OUTPUT_HEADERS = StrEnum("Output CSV Headers", [
     "PERCENTAGE",
 ])
 
+# The largest total cell count for which `percentage_hundredths` can't overflow an int64
+MAX_TOTAL_COUNT = np.iinfo(np.int64).max // 20_001
+
+# The batch converter of a worker process, as built by `init_batch_worker`
+worker_convert_batch: Callable[[Csv], Csv] | None = None
 
-def get_output_csv_row(sample: str, total_count: int, population: str, count: int) -> list[str]:
+
+def percentage_hundredths(counts: np.ndarray, totals: np.ndarray) -> np.ndarray:
     """
-    Generates a single row for the output CSV.
+    Computes each cell count as a percentage of its sample's total, in whole hundredths of a
+    percent.
+
+    Only integer arithmetic is used, so the exact ratio is rounded (half up) without any
+    floating-point error. Totals must be at most `MAX_TOTAL_COUNT`, or the scaled values overflow.
 
     Args:
-        sample (str):      The sample ID
-        total_count (int): The total cell count for the entire sample
-        population (str):  The name of the individual immune cell population
-        count (int):       The cell count for the population
+        counts (np.ndarray): The cell counts, with one row per sample
+        totals (np.ndarray): The total cell count of each sample
 
     Returns:
-        list[str]: A row for the output CSV
+        np.ndarray: The percentages, scaled by 100 and rounded to integers
     """
-    percentage = (count / total_count) * 100
-    return [sample, str(total_count), population, str(count), f"{percentage:.2f}"]
+    totals = totals[:, np.newaxis]
+    return (counts * 20_000 + totals) // (totals * 2)
 
 
-def convert_sample_cell_count(csv_headers: CsvHeaders, csv_row: list[str]) -> Csv:
+def make_batch_converter(csv_headers: CsvHeaders) -> Callable[[Csv], Csv]:
     """
-    Converts a single sample into rows with relative cell counts for individual populations.
+    Builds a function that converts batches of samples into rows with relative cell counts for
+    individual populations.
+
+    The column lookups for the given headers are resolved once here, rather than for every batch.
 
     Args:
         csv_headers (CsvHeaders): A mapping of header names to their respective indices
-        csv_row (list[str]):      A single row from the input CSV
 
     Returns:
-        Csv: A list of rows for the output CSV
+        Callable[[Csv], Csv]: The batch converter
+    """
+    get_counts = itemgetter(*(csv_headers[cell_type] for cell_type in CELL_TYPE_ORDER))
+    get_sample = itemgetter(csv_headers[SAMPLE_HEADER])
+    # Plain strings, so that output rows can be sent between processes
+    populations = tuple(map(str, CELL_TYPE_ORDER))
+
+    def convert_batch(csv_rows: Csv) -> Csv:
+        """
+        Converts a batch of samples into rows with relative cell counts for individual populations.
+
+        All cell counts in the batch are parsed into a single array so that the totals and
+        percentages can be computed for every sample at once.
+
+        Args:
+            csv_rows (Csv): A batch of rows from the input CSV
+
+        Returns:
+            Csv: A list of rows for the output CSV, in the order of `OUTPUT_HEADERS`
+
+        Raises:
+            ValueError: if any cell count is not an integer or is negative, or any sample has no
+                        cells or too many to convert exactly
+        """
+        # Pull every count column out of each row in one C-level call, then let NumPy parse them
+        # all at once; allow it to throw an Error if casting to int fails
+        try:
+            counts = np.array(list(map(get_counts, csv_rows)), dtype=np.int64)
+        except OverflowError as error:
+            raise ValueError("Given CSV is invalid; cell counts must be at most "
+                             f"{MAX_TOTAL_COUNT}") from error
+        # The integer percentage rounding only holds for non-negative values
+        if (counts < 0).any():
+            raise ValueError("Given CSV is invalid; cell counts must not be negative")
+        # Check the counts before summing them, so the totals themselves can't overflow either
+        if (counts > MAX_TOTAL_COUNT).any():
+            raise ValueError(f"Given CSV is invalid; cell counts must be at most {MAX_TOTAL_COUNT}")
+        totals = counts.sum(axis=1)
+        if not totals.all():
+            raise ValueError("Given CSV is invalid; every sample must have a nonzero total cell "
+                             "count")
+        if (totals > MAX_TOTAL_COUNT).any():
+            raise ValueError("Given CSV is invalid; every sample's total cell count must be at "
+                             f"most {MAX_TOTAL_COUNT}")
+        whole_percents, hundredths = np.divmod(percentage_hundredths(counts, totals), 100)
+
+        # Build every output row in one pass over the batch, with no per-sample intermediates
+        output_rows: Csv = []
+        for sample, total_count, sample_counts, sample_whole_percents, sample_hundredths \
+                in zip(map(get_sample, csv_rows), map(str, totals.tolist()), counts.tolist(),
+                       whole_percents.tolist(), hundredths.tolist()):
+            output_rows.extend([sample, total_count, cell_type, str(count),
+                                f"{whole_percent}.{hundredth:02d}"]
+                               for cell_type, count, whole_percent, hundredth
+                               in zip(populations, sample_counts, sample_whole_percents,
+                                      sample_hundredths))
+        return output_rows
+
+    return convert_batch
+
+
+def usable_cpu_count() -> int:
     """
-    total_count = 0
-    cell_counts: dict[CELL_TYPES, int] = {}
-    for cell_type in CELL_TYPES:
-        # Allow it to throw an Error if casting to int fails
-        cell_count = int(csv_row[csv_headers[cell_type]])
-        total_count += cell_count
-        cell_counts[cell_type] = cell_count
+    Counts the CPUs this process is allowed to run on, respecting any CPU affinity restrictions
+    (e.g., from a container), unlike `os.cpu_count`.
 
-    output_rows: Csv = []
-    sample = csv_row[csv_headers[SAMPLE_HEADER]]
-    for cell_type in CELL_TYPES:
-        output_rows.append(get_output_csv_row(sample, total_count, cell_type,
-                                              cell_counts[cell_type]))
-    return output_rows
+    Returns:
+        int: The number of usable CPUs (at least 1)
+    """
+    if hasattr(os, "process_cpu_count"):  # Python 3.13+
+        return os.process_cpu_count() or 1
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0)) or 1
+    return os.cpu_count() or 1
 
 
-def convert_cell_count(csv_headers: CsvHeaders, csv_rows: Csv) -> Csv:
+def init_batch_worker(csv_headers: CsvHeaders) -> None:
     """
-    Converts a CSV into a new CSV with relative cell counts for individual populations.
+    Initializes a worker process by building its batch converter once, for every batch it will
+    convert.
 
     Args:
         csv_headers (CsvHeaders): A mapping of header names to their respective indices
-        csv_rows (Csv):           The input CSV
+    """
+    global worker_convert_batch
+    worker_convert_batch = make_batch_converter(csv_headers)
+
+
+def convert_batch_cell_count(csv_rows: Csv) -> Csv:
+    """
+    Converts a single batch of samples into rows with relative cell counts for individual
+    populations, as a top-level function that can be run in a worker process.
+
+    Args:
+        csv_rows (Csv): A batch of rows from the input CSV
+
+    Returns:
+        Csv: A list of rows for the output CSV, in the order of `OUTPUT_HEADERS`
+    """
+    if worker_convert_batch is None:
+        raise RuntimeError("convert_batch_cell_count called outside of an initialized worker")
+    return worker_convert_batch(csv_rows)
+
+
+def convert_cell_count(csv_headers: CsvHeaders, csv_rows: Iterable[list[str]]) \
+        -> tuple[list[str], CsvRows]:
+    """
+    Converts a CSV into a new CSV with relative cell counts for individual populations.
+
+    Args:
+        csv_headers (CsvHeaders):       A mapping of header names to their respective indices
+        csv_rows (Iterable[list[str]]): The rows of the input CSV
 
     Returns:
-        Csv: The completed output CSV
+        tuple[list[str], CsvRows]: The header row of the output CSV, and an iterator which lazily \
+                                   converts the remaining rows
+    """
+    return list(OUTPUT_HEADERS), convert_cell_count_rows(csv_headers, csv_rows)
+
+
+def convert_cell_count_rows(csv_headers: CsvHeaders, csv_rows: Iterable[list[str]]) -> CsvRows:
     """
-    output_csv: Csv = [list(OUTPUT_HEADERS)]
-    for csv_row in csv_rows:
-        output_csv.extend(convert_sample_cell_count(csv_headers, csv_row))
-    return output_csv
+    Lazily converts the rows of a CSV into rows with relative cell counts for individual
+    populations.
+
+    Inputs spanning multiple batches are converted across a pool of worker processes, with only a
+    few batches in flight at a time so that the input is still streamed.
+
+    Args:
+        csv_headers (CsvHeaders):       A mapping of header names to their respective indices
+        csv_rows (Iterable[list[str]]): The rows of the input CSV
+
+    Yields:
+        list[str]: Each row of the output CSV, in the order of `OUTPUT_HEADERS`
+    """
+    csv_rows = iter(csv_rows)
+    batches = iter(lambda: list(islice(csv_rows, BATCH_SIZE)), [])
+    leading_batches = list(islice(batches, 2))
+    batches = chain(leading_batches, batches)
+    process_count = usable_cpu_count()
+
+    if len(leading_batches) < 2 or process_count < 2:
+        # Not enough work to be worth starting worker processes
+        convert_batch = make_batch_converter(csv_headers)
+        for batch in batches:
+            yield from convert_batch(batch)
+        return
+
+    # The header names may be enum members, which can't be sent to another process
+    plain_headers = {str(header): index for header, index in csv_headers.items()}
+    with Pool(process_count, initializer=init_batch_worker, initargs=(plain_headers,)) as pool:
+        # Keep results in input order, and stop reading ahead once enough batches are pending
+        pending: deque[AsyncResult] = deque()
+        for batch in batches:
+            pending.append(pool.apply_async(convert_batch_cell_count, (batch,)))
+            if len(pending) >= process_count * BATCHES_PER_PROCESS:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
 
 
 def parse_args(args: list[str]) -> argparse.Namespace:
@@ -135,8 +284,8 @@ def main(args: list[str]) -> int:
     required_headers = [SAMPLE_HEADER] + list(CELL_TYPES)
     csv_headers, csv_rows = read_csv(arg_values.csv_file, required_headers,
                                      delimiter=arg_values.delimiter)
-    output_csv = convert_cell_count(csv_headers, csv_rows)
-    write_csv(arg_values.output, output_csv, delimiter=arg_values.delimiter)
+    header_row, output_rows = convert_cell_count(csv_headers, csv_rows)
+    write_csv(arg_values.output, output_rows, delimiter=arg_values.delimiter, header=header_row)
     return 0
 
 